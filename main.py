@@ -1,8 +1,13 @@
+from collections import defaultdict
 from datetime import date, timedelta
-from google.cloud import bigquery
-from google.oauth2 import service_account
+import functools
+import hashlib
+import io
+import orjson
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import json
 import logging
 
@@ -14,25 +19,59 @@ SERVICE_ACCOUNT_FILE = "/var/secrets/billing-sa"
 # --- Options controlled by environment variables ---
 SEND_PROJECT_BREAKDOWN = os.getenv("SEND_PROJECT_BREAKDOWN", "false").lower() in ("true", "1", "yes")
 SEND_THREAD_DETAILS = os.getenv("SEND_THREAD_DETAILS", "false").lower() in ("true", "1", "yes")
+ENABLE_CACHE = os.getenv("ENABLE_CACHE", "false").lower() in ("true", "1", "yes")
+# Must be a persistent volume: each run starts a fresh container, so a local directory is never reused
+CACHE_DIR = os.getenv("CACHE_DIR", "/tmp/gcp-billing-bot-cache")
+# Report dates younger than this (in days) may still receive late-exported usage and are never cached
+CACHE_FINAL_AFTER_DAYS = int(os.getenv("CACHE_FINAL_AFTER_DAYS", "3"))
+
+# Timeout (seconds) for Slack API calls
+SLACK_TIMEOUT = 10
+# Maximum number of blocks per thread message (Slack allows up to 50)
+BLOCKS_PER_MSG = 48
+# Maximum table text per thread message. A full project table is about 2.2k characters,
+# so this keeps a message well below Slack's 40k-character message limit.
+THREAD_MSG_MAX_CHARS = 12000
+# Results with more rows than this are downloaded through the BigQuery Storage Read API
+BQSTORAGE_MIN_ROWS = 10000
 
 logging.basicConfig(level=logging.INFO)
 
+# --- Shared HTTP session for Slack API calls (keep-alive connections, retries on rate limits) ---
+# chat.postMessage is not idempotent, so POSTs are only retried when Slack certainly did not
+# process them: connection errors and 429 (honouring Retry-After). Read timeouts and 5xx
+# responses are not retried, since the message may already have been posted.
+_SESSION = requests.Session()
+_SESSION.headers.update({
+    "Content-Type": "application/json",
+    "Authorization": f"Bearer {SLACK_API_TOKEN}"
+})
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, read=0, backoff_factor=0.3, status_forcelist=[429],
+                      allowed_methods=["POST"])
+))
+
+# Direct message channel IDs resolved by conversations.open, keyed by user ID
+_DM_CHANNELS = {}
+
 def send_slack_message(blocks, fallback_text="GCP Cost Report", thread_ts=None, channel_id=SLACK_CHANNEL_ID):
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {SLACK_API_TOKEN}"
-    }
     final_channel = channel_id
     # If a user ID is passed (starts with "U"), open a direct message channel first.
-    if channel_id.startswith("U"):
+    # DM channel IDs are cached per process, so conversations.open is called once per user.
+    if channel_id in _DM_CHANNELS:
+        final_channel = _DM_CHANNELS[channel_id]
+    elif channel_id.startswith("U"):
         open_payload = {"users": channel_id}
         try:
-            open_response = requests.post("https://slack.com/api/conversations.open",
-                                          data=json.dumps(open_payload),
-                                          headers=headers)
+            open_response = _SESSION.post("https://slack.com/api/conversations.open",
+                                          data=orjson.dumps(open_payload),
+                                          timeout=SLACK_TIMEOUT)
             open_data = open_response.json()
             if open_data.get("ok"):
                 final_channel = open_data["channel"]["id"]
+                _DM_CHANNELS[channel_id] = final_channel
             else:
                 logging.error(f"Error opening DM: {open_data.get('error')}")
         except requests.exceptions.RequestException as e:
@@ -45,11 +84,10 @@ def send_slack_message(blocks, fallback_text="GCP Cost Report", thread_ts=None,
     }
     if thread_ts is not None:
         payload["thread_ts"] = thread_ts
-    payload_json = json.dumps(payload)
     try:
-        response = requests.post("https://slack.com/api/chat.postMessage",
-                                 data=payload_json,
-                                 headers=headers)
+        response = _SESSION.post("https://slack.com/api/chat.postMessage",
+                                 data=orjson.dumps(payload),
+                                 timeout=SLACK_TIMEOUT)
         response_data = response.json()
         if not response_data.get("ok"):
             logging.error(f"Error sending message to Slack: {response_data.get('error')}")
@@ -61,46 +99,108 @@ def send_slack_message(blocks, fallback_text="GCP Cost Report", thread_ts=None,
         logging.error(f"Error calling Slack API: {e}")
         return None
 
+# --- BigQuery client, reused across invocations of a warm instance ---
+@functools.lru_cache(maxsize=1)
+def get_bq_client():
+    # Imported here rather than at module level: the BigQuery client pulls in protobuf/grpc,
+    # which is only needed once a report is actually requested.
+    from google.cloud import bigquery
+    from google.oauth2 import service_account
+
+    credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE)
+    return bigquery.Client(credentials=credentials, project=credentials.project_id)
+
+# --- Query result cache ---
+# Usage of a day can still be exported a few days later, so only dates at least CACHE_FINAL_AFTER_DAYS
+# old are cached. For those, results are cached per (table, date, query) and repeated runs
+# do not scan (and pay for) the billing table again.
+# Columns every cached row must have; files written by an older query are treated as a cache miss
+CACHE_ROW_KEYS = ("project_id", "service_name", "yesterday_cost", "delta_percentage", "g_p", "g_s")
+
+def _cache_path(cost_date, query):
+    # The key includes a hash of the query, so a changed query (and row schema) never reads old files
+    query_hash = hashlib.sha256(query.encode()).hexdigest()[:12]
+    return os.path.join(CACHE_DIR, f"{BQ_TABLE}.{cost_date}.{query_hash}.json")
+
+def load_cached_rows(cost_date, query):
+    path = _cache_path(cost_date, query)
+    try:
+        with open(path) as f:
+            rows = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning(f"Error reading cache file {path}: {e}")
+        return None
+    if not isinstance(rows, list) or not all(isinstance(r, dict) and all(k in r for k in CACHE_ROW_KEYS) for r in rows):
+        logging.warning(f"Ignoring cache file {path}: unexpected row format")
+        return None
+    logging.info(f"Loaded cached query result from {path}")
+    return rows
+
+def save_cached_rows(cost_date, query, rows):
+    path = _cache_path(cost_date, query)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(rows, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.warning(f"Error writing cache file {path}: {e}")
+
+# --- Cell formatting shared by all tables ---
+def _fmt_cost(cost):
+    return f"{cost:.2f}"
+
+def _fmt_delta(delta_percentage):
+    return "N/A" if delta_percentage is None else f"{int(delta_percentage)}%"
+
 # --- Function to build a text table ---
-def build_table(header_names, rows, overall_label, overall_cost, overall_delta):
+def build_table(header_names, rows, overall_label=None, overall_cost=None, overall_delta=None):
     max_lines = 34
     header_lines = 2  # header and separator
-    footer_lines = 2  # separator and overall (TOTAL) row
+    footer_lines = 2  # separator and overall (TOTAL) row, if any
     max_data_rows = max_lines - header_lines - footer_lines
 
-    # Calculate column widths
-    col_widths = []
-    for i, col in enumerate(header_names):
-        if not rows:
-            col_width = len(col)
-        else:
-            col_width = max(len(col), *(len(str(row[i])) for row in rows))
-        col_widths.append(col_width)
-
-    header_line = "  ".join(header_names[i].ljust(col_widths[i]) for i in range(len(header_names)))
-    separator = "-" * (sum(col_widths) + 2 * (len(col_widths) - 1))
-    table_lines = [header_line, separator]
-
     # Limit the number of data rows so that the footer always fits
     if len(rows) > max_data_rows:
         rows = rows[:max_data_rows]
+
+    # Convert each cell to a string once and calculate column widths in the same pass
+    col_widths = [len(col) for col in header_names]
+    str_rows = []
     for row in rows:
-        line = "  ".join(str(row[i]).ljust(col_widths[i]) if i == 0 else str(row[i]).rjust(col_widths[i])
-                         for i in range(len(row)))
-        table_lines.append(line)
+        str_row = [str(value) for value in row]
+        str_rows.append(str_row)
+        for i, cell in enumerate(str_row):
+            if len(cell) > col_widths[i]:
+                col_widths[i] = len(cell)
 
-    # Build the overall row
-    overall_line = f"{overall_label.ljust(col_widths[0])}  {overall_cost.rjust(col_widths[1])}"
-    if len(header_names) > 2:
-        overall_line += "  " + overall_delta.rjust(col_widths[2])
-    
-    table_lines.append(separator)
-    table_lines.append(overall_line)
-    
-    # If the total number of lines exceeds max_lines, trim them (should not happen with proper limits)
-    if len(table_lines) > max_lines:
-        table_lines = table_lines[:max_lines]
-    return "\n".join(table_lines)
+    # Build format templates once: the header is left-aligned, data rows are left-aligned
+    # in the first column and right-aligned in the others
+    header_fmt = "  ".join(f"{{:<{w}}}" for w in col_widths)
+    row_fmt = "  ".join([f"{{:<{col_widths[0]}}}"] + [f"{{:>{w}}}" for w in col_widths[1:]])
+
+    separator = "-" * (sum(col_widths) + 2 * (len(col_widths) - 1))
+    buf = io.StringIO()
+    buf.write(header_fmt.format(*header_names))
+    buf.write("\n")
+    buf.write(separator)
+    buf.write("\n")
+
+    for str_row in str_rows:
+        buf.write(row_fmt.format(*str_row))
+        buf.write("\n")
+
+    # Build the overall row (the delta is dropped by format() for two-column tables),
+    # unless the table is built without one.
+    # Data rows are limited above, so the table never exceeds max_lines.
+    if overall_label is not None:
+        buf.write(separator)
+        buf.write("\n")
+        buf.write(row_fmt.format(overall_label, overall_cost, overall_delta))
+    return buf.getvalue().rstrip("\n")
 
 # --- Main function ---
 def get_gcp_cost(request):
@@ -110,138 +210,127 @@ def get_gcp_cost(request):
     It builds two blocks for the main message:
       1) A table aggregated by SKU across all projects with an OVERALL row.
       2) A table with totals by project.
-    Then, in a thread to this message, it sends separate messages for each project with detailed SKU breakdown.
+    Then, in a thread to this message, it sends a detailed SKU breakdown for each project
+    (several projects per message, separated by dividers, limited by block count and text size).
     Each block is limited to 30 lines (extra lines are trimmed, but the overall row is preserved).
     """
-    try:
-        credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE)
-        client = bigquery.Client(credentials=credentials, project=credentials.project_id)
-    except Exception as e:
-        err_msg = f"Error authorizing with BigQuery: {e}"
-        logging.error(err_msg)
-        send_slack_message([{"type": "section", "text": {"type": "mrkdwn", "text": err_msg}}], fallback_text=err_msg)
-        return "Error"
-
-    # --- Compute the date (day before yesterday) ---
-    cost_date = (date.today() - timedelta(days=2)).strftime("%Y-%m-%d")
+    # --- Compute the dates (day before yesterday and the day before that) ---
+    report_date = date.today() - timedelta(days=2)
+    previous_date = report_date - timedelta(days=1)
+    cost_date = report_date.strftime("%Y-%m-%d")
+    use_cache = ENABLE_CACHE and (date.today() - report_date).days >= CACHE_FINAL_AFTER_DAYS
 
     # --- BigQuery Query ---
+    # Aggregation is done by BigQuery: GROUPING SETS returns the per-project SKU rows,
+    # the project totals, the SKU totals across projects and the overall total in one result.
+    # Dates are passed as query parameters instead of CURRENT_DATE(), which would disable
+    # BigQuery's query result cache.
     query = f"""
     WITH cost_data AS (
       SELECT 
         project.id AS project_id,
-        sku.description AS service_name,
+        SUBSTR(sku.description, 1, 45) AS service_name,  -- Trim to 45 characters
         DATE(usage_start_time) AS cost_date,
         SUM(cost) AS total_cost
       FROM {BQ_TABLE}
-      WHERE DATE(usage_start_time) IN (CURRENT_DATE() - 2, CURRENT_DATE() - 3)
+      -- Filter on the partition column so that only recent partitions are scanned.
+      -- Usage of a day can be exported later, so the partition range has no upper bound.
+      WHERE _PARTITIONTIME >= TIMESTAMP(@previous_date)
+        AND usage_start_time >= TIMESTAMP(@previous_date)
+        AND usage_start_time < TIMESTAMP(DATE_ADD(@report_date, INTERVAL 1 DAY))
       GROUP BY project_id, service_name, cost_date
     )
     SELECT
       a.project_id,
       a.service_name,
-      a.total_cost AS yesterday_cost,
-      b.total_cost AS day_before_cost,
+      IFNULL(SUM(a.total_cost), 0) AS yesterday_cost,
       CASE 
-        WHEN b.total_cost IS NULL OR b.total_cost = 0 THEN NULL
-        ELSE ROUND((a.total_cost - b.total_cost) / b.total_cost * 100)
-      END AS delta_percentage
+        WHEN SUM(b.total_cost) > 0 THEN ROUND((SUM(a.total_cost) - SUM(b.total_cost)) / SUM(b.total_cost) * 100)
+        ELSE NULL
+      END AS delta_percentage,
+      GROUPING(a.project_id) AS g_p,
+      GROUPING(a.service_name) AS g_s
     FROM cost_data a
     LEFT JOIN cost_data b
       ON a.project_id = b.project_id 
       AND a.service_name = b.service_name 
-      AND b.cost_date = CURRENT_DATE() - 3
-    WHERE a.cost_date = CURRENT_DATE() - 2
-    ORDER BY a.project_id, yesterday_cost DESC
+      AND b.cost_date = @previous_date
+    WHERE a.cost_date = @report_date
+      AND a.total_cost != 0
+    GROUP BY GROUPING SETS ((a.project_id, a.service_name), (a.project_id), (a.service_name), ())
+    ORDER BY yesterday_cost DESC
     """
     
     try:
-        query_job = client.query(query)
-        result = query_job.result()
-        
-        # --- Data Aggregation ---
-        overall_total_yesterday = 0.0
-        overall_total_day_before = 0.0
+        rows = load_cached_rows(cost_date, query) if use_cache else None
+        if rows is None:
+            # The client is only needed (and authorized) when the result is not cached
+            try:
+                client = get_bq_client()
+            except Exception as e:
+                err_msg = f"Error authorizing with BigQuery: {e}"
+                logging.error(err_msg)
+                send_slack_message([{"type": "section", "text": {"type": "mrkdwn", "text": err_msg}}], fallback_text=err_msg)
+                return "Error"
+
+            from google.cloud import bigquery
+
+            job_config = bigquery.QueryJobConfig(
+                use_query_cache=True,
+                query_parameters=[
+                    bigquery.ScalarQueryParameter("report_date", "DATE", report_date),
+                    bigquery.ScalarQueryParameter("previous_date", "DATE", previous_date),
+                ]
+            )
+            query_job = client.query(query, job_config=job_config)
+            # The aggregated result (a few hundred rows) fits in the first REST page, so it is read
+            # directly without importing pyarrow. Only unusually large results are downloaded through
+            # the BigQuery Storage Read API (Arrow over gRPC). That needs bigquery.readsessions.create
+            # and the BigQuery Storage API enabled; without them the rows are re-read over REST.
+            result = query_job.result()
+            if result.total_rows > BQSTORAGE_MIN_ROWS:
+                from google.api_core.exceptions import Forbidden, PermissionDenied
+
+                try:
+                    rows = result.to_arrow(create_bqstorage_client=True).to_pylist()
+                except (Forbidden, PermissionDenied) as e:
+                    logging.warning(f"BigQuery Storage API is not available, reading rows over REST: {e}")
+                    rows = [dict(r.items()) for r in query_job.result()]
+            else:
+                rows = [dict(r.items()) for r in result]
+            logging.info(f"BigQuery bytes billed: {query_job.total_bytes_billed}, cache hit: {query_job.cache_hit}")
+            if use_cache:
+                save_cached_rows(cost_date, query, rows)
         
-        projects = {}      # Detailed breakdown by project (for thread messages)
-        sku_agg = {}       # Aggregated breakdown by SKU (across projects)
-        project_totals = {}# Totals by project
+        # --- Dispatch aggregated rows (already sorted by cost) into the tables ---
+        projects = defaultdict(list)  # Detailed breakdown by project (for thread messages)
+        sku_rows = []                 # Aggregated breakdown by SKU (across projects)
+        project_rows = []             # Totals by project
+        overall_cost_str = _fmt_cost(0)
+        overall_delta_str = _fmt_delta(None)
         
-        for r in result:
-            # Skip rows with a cost of 0.00
-            if r.yesterday_cost == 0:
-                continue
+        for r in rows:
+            cost_str = _fmt_cost(r["yesterday_cost"])
+            delta_str = _fmt_delta(r["delta_percentage"])
 
-            project = r.project_id
-            overall_total_yesterday += r.yesterday_cost
-            overall_total_day_before += (r.day_before_cost or 0)
-            if project not in projects:
-                projects[project] = {"rows": [], "total_yesterday": 0.0, "total_day_before": 0.0}
-            service = r.service_name[:45]  # Trim to 45 characters
-            cost = r.yesterday_cost
-            cost_str = f"{cost:.2f}"
-            delta_str = "N/A" if (r.delta_percentage is None) else f"{int(r.delta_percentage)}%"
-            projects[project]["rows"].append((service, cost_str, delta_str))
-            projects[project]["total_yesterday"] += cost
-            projects[project]["total_day_before"] += (r.day_before_cost or 0)
-            
-            # Aggregated breakdown by SKU
-            if service not in sku_agg:
-                sku_agg[service] = {"yesterday": 0.0, "day_before": 0.0}
-            sku_agg[service]["yesterday"] += cost
-            sku_agg[service]["day_before"] += (r.day_before_cost or 0)
-            
-            # Totals by project
-            if project not in project_totals:
-                project_totals[project] = {"total_yesterday": 0.0, "total_day_before": 0.0}
-            project_totals[project]["total_yesterday"] += cost
-            project_totals[project]["total_day_before"] += (r.day_before_cost or 0)
-        
-        # --- Build Table 1: Aggregated breakdown by SKU (across all projects) ---
-        sku_rows = []
-        sorted_sku = sorted(sku_agg.items(), key=lambda item: item[1]["yesterday"], reverse=True)
-        for sku, vals in sorted_sku:
-            cost_str = f"{vals['yesterday']:.2f}"
-            if vals['day_before'] > 0:
-                delta = round((vals["yesterday"] - vals["day_before"]) / vals["day_before"] * 100)
-                delta_str = f"{delta}%"
+            grouping = (r["g_p"], r["g_s"])
+            if grouping == (0, 0):
+                projects[r["project_id"]].append((r["service_name"], cost_str, delta_str))
+            elif grouping == (0, 1):
+                project_rows.append((r["project_id"], cost_str, delta_str))
+            elif grouping == (1, 0):
+                sku_rows.append((r["service_name"], cost_str, delta_str))
             else:
-                delta_str = "N/A"
-            sku_rows.append((sku, cost_str, delta_str))
-        overall_sku_cost = f"{overall_total_yesterday:.2f}"
-        if overall_total_day_before > 0:
-            overall_sku_delta = round((overall_total_yesterday - overall_total_day_before) / overall_total_day_before * 100)
-            overall_sku_delta_str = f"{overall_sku_delta}%"
-        else:
-            overall_sku_delta_str = "N/A"
+                overall_cost_str = cost_str
+                overall_delta_str = delta_str
         
+        # --- Build Table 1: Aggregated breakdown by SKU (across all projects) ---
         # Pass overall_label="OVERALL" so that the table ends with an OVERALL row
-        sku_table_text = build_table(["SKU", "Cost", "Delta"], sku_rows, "OVERALL", overall_sku_cost, overall_sku_delta_str)
+        sku_table_text = build_table(["SKU", "Cost", "Delta"], sku_rows, "OVERALL", overall_cost_str, overall_delta_str)
         
         # --- Build Table 2: Totals by project ---
-        project_rows = []
-        sorted_projects = sorted(project_totals.items(), key=lambda item: item[1]["total_yesterday"], reverse=True)
-        for proj, totals in sorted_projects:
-            cost_str = f"{totals['total_yesterday']:.2f}"
-            if totals['total_day_before'] > 0:
-                delta = round((totals["total_yesterday"] - totals["total_day_before"]) / totals["total_day_before"] * 100)
-                delta_str = f"{delta}%"
-            else:
-                delta_str = "N/A"
-            project_rows.append((proj, cost_str, delta_str))
-        overall_proj_cost = f"{overall_total_yesterday:.2f}"
-        if overall_total_day_before > 0:
-            overall_proj_delta = round((overall_total_yesterday - overall_total_day_before) / overall_total_day_before * 100)
-            overall_proj_delta_str = f"{overall_proj_delta}%"
-        else:
-            overall_proj_delta_str = "N/A"
-        # Build the full project table, then remove the OVERALL row (last 2 lines)
-        project_table_text_full = build_table(["Project", "Cost", "Delta"], project_rows, "OVERALL", overall_proj_cost, overall_proj_delta_str)
-        project_table_text_lines = project_table_text_full.split("\n")
-        if len(project_table_text_lines) >= 2:
-            project_table_text = "\n".join(project_table_text_lines[:-2])
-        else:
-            project_table_text = project_table_text_full
+        # The project table has no OVERALL row (it is already shown in the SKU table)
+        project_table_text = build_table(["Project", "Cost", "Delta"], project_rows)
         
         # --- Build Date Block ---
         date_block = {
@@ -268,21 +357,12 @@ def get_gcp_cost(request):
         
         # --- Send Thread Messages for each project (detailed breakdown by SKU) ---
         if SEND_THREAD_DETAILS:
-            # Sort projects by total cost (from highest to lowest)
-            sorted_projects_by_cost = sorted(projects.items(), key=lambda item: item[1]["total_yesterday"], reverse=True)
-            for proj, data in sorted_projects_by_cost:
-                rows = data["rows"]
-                total_yesterday = data["total_yesterday"]
-                total_day_before = data["total_day_before"]
-                if total_day_before > 0:
-                    proj_delta = round((total_yesterday - total_day_before) / total_day_before * 100)
-                    proj_delta_str = f"{proj_delta}%"
-                else:
-                    proj_delta_str = "N/A"
-                # Sort rows within the project by cost descending
-                proj_rows = sorted(rows, key=lambda r: float(r[1]), reverse=True)
-                total_str = f"{total_yesterday:.2f}"
-                proj_table_text = build_table(["SKU", "Cost", "Delta"], proj_rows, "TOTAL", total_str, proj_delta_str)
+            # Projects are already sorted by total cost (from highest to lowest).
+            # Several projects are packed into one thread message, separated by dividers.
+            thread_messages = []
+            batch_projects, batch_blocks, batch_chars = [], [], 0
+            for proj, total_str, proj_delta_str in project_rows:
+                proj_table_text = build_table(["SKU", "Cost", "Delta"], projects[proj], "TOTAL", total_str, proj_delta_str)
                 
                 # Build header block with project name
                 thread_header_block = {
@@ -294,8 +374,28 @@ def get_gcp_cost(request):
                     "type": "section",
                     "text": {"type": "mrkdwn", "text": f"```\n{proj_table_text}\n```"}
                 }
-                # Send as thread message to the main message (main_ts)
-                send_slack_message([thread_header_block, thread_table_block], thread_ts=main_ts)
+                # Start a new message if the divider, header and table blocks or the table text do not fit
+                if batch_blocks and (len(batch_blocks) + 3 > BLOCKS_PER_MSG
+                                     or batch_chars + len(proj_table_text) > THREAD_MSG_MAX_CHARS):
+                    thread_messages.append((batch_projects, batch_blocks))
+                    batch_projects, batch_blocks, batch_chars = [], [], 0
+                if batch_blocks:
+                    batch_blocks.append({"type": "divider"})
+                batch_blocks.extend([thread_header_block, thread_table_block])
+                batch_projects.append(proj)
+                batch_chars += len(proj_table_text)
+            if batch_blocks:
+                thread_messages.append((batch_projects, batch_blocks))
+
+            # Send as thread messages to the main message (main_ts), one after another:
+            # Slack orders replies by timestamp, so this keeps the projects sorted by cost.
+            # A failure for one message is logged and does not stop the others.
+            for batch, blocks in thread_messages:
+                try:
+                    send_slack_message(blocks, thread_ts=main_ts)
+                except Exception as e:
+                    projects_str = ", ".join(str(proj) for proj in batch)
+                    logging.error(f"Error sending thread message for projects {projects_str}: {e}")
         
         return "Success"
     except Exception as e: